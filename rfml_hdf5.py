@@ -1,9 +1,24 @@
 # hdf5 wrapper functions for handling typical hdf5 data files written by finite difference solver NGA.
 
+import functools
 import h5py
 import os
 import numpy as np
 
+# hdf5 file format version bounds used by every function that writes or modifies files.
+# 'latest' keeps metadata compact and avoids its fragmentation on edits, set to 'earliest'
+# if the files have to stay readable with HDF5 1.8 based tools
+_HDF5_LIBVER = 'latest'
+# files with deleted objects whose repack was deferred because a handle on them was still open
+_PENDING_REPACK = set()
+# number of open RfmlHdf5 handles per file, a file is never repacked while it is open
+_OPEN_HANDLES = {}
+# numba is optional and imported on first use only; compiling costs a few tenths of a second per
+# process, so numeric helpers use it only for arrays of at least _NUMBA_MIN_SIZE elements
+_NUMBA_MIN_SIZE = 1 << 24
+_MIDPOINTS_NB = None	# compiled kernel of _midpoints, False if numba is not available
+# is_rfml_hdf5 results, filename -> (modification time, status), one entry per file
+_RFML_CACHE = {}
 
 ### ====== RFML specific hdf5 functions and wrappers ====== ###
 def is_rfml_hdf5(filename):
@@ -12,22 +27,19 @@ def is_rfml_hdf5(filename):
 		1. should contain group '/data'
 		2. should contain attributes '/data/dimensions','/data/datafield_names'
 	"""
-	fid = h5py.File(filename, 'r')
-	try:
-		# Should contain group 'data'
-		status = False
-		if ('data' in list(fid)):
-			# data must contain attributes 'datafield_names' and 'dimensions'
-			gid = fid['data']
-			attrManager = gid.attrs
-			attrList = list(attrManager)
-			if ('datafield_names' in attrList and 'dimensions' in attrList):
-				status = True
-	finally:
-		fid.close()
-		return status
-
-def hdf5_NGA_config_write(filename, simname, x, y, z, icyl, iper, mask, endian='little-endian'):
+	mtime_ns = os.stat(filename).st_mtime_ns
+	cached = _RFML_CACHE.get(filename)
+	if (cached is not None and cached[0] == mtime_ns):
+		return cached[1]
+
+	# miss, or the file was modified since: the entry is overwritten
+	with RfmlHdf5(filename, 'r') as h5:
+		status = h5.is_rfml()
+	_RFML_CACHE[filename] = (mtime_ns, status)
+	return status
+
+def hdf5_NGA_config_write(filename, simname, x, y, z, icyl, iper, mask, endian='little-endian', comm=None,
+						  collective_metadata=True, pack_mask=False):
 	"""
 		Wrapper function to write configuration file for NGA simulations in RFML hdf5 convention
 		function is structured same as matlab function in RFML matlab repository.
@@ -39,8 +51,18 @@ def hdf5_NGA_config_write(filename, simname, x, y, z, icyl, iper, mask, endian='
 		iper	 : 3 x 1 array for periodicity in the three directions
 		mask	 : 2D numpy integer array of shape (x.size - 1, y.size - 1)
 		endian	 : 'little-endian' or 'big-endian'
+		comm	 : optional mpi4py communicator, all ranks of comm write the file through the 'mpio' driver
+		collective_metadata : use collective metadata reads and writes when comm is given
+		pack_mask : store a mask of zeros and ones bit-packed as uint8 with its shape in attribute
+					'mask_packed' (32x smaller). NGA itself cannot read it, use hdf5_read_mask
 	"""
-	fid = h5py.File(filename, 'w')
+	_invalidate_rfml_cache(filename)
+	dxpl = None
+	if (comm is None):
+		fid = h5py.File(filename, 'w', libver=_HDF5_LIBVER)
+	else:
+		fid = _mpio_file_create(filename, comm, collective_metadata)
+		dxpl = _mpio_collective_dxpl()
 	try:
 		group_id = fid.create_group('/data')
 		# Attributes
@@ -48,7 +70,7 @@ def hdf5_NGA_config_write(filename, simname, x, y, z, icyl, iper, mask, endian='
 		write_type = h5py.h5t.C_S1.copy()
 		write_type.set_size(64)
 		write_type.set_strpad(h5py.h5t.STR_SPACEPAD)
-		__oned_attribute_write(group_id, 'simulation_name', write_type, simname)
+		_oned_attribute_write(group_id, 'simulation_name', write_type, simname)
 		#-> parameters
 		if(endian=='big-endian'):
 			write_type = h5py.h5t.STD_I32BE
@@ -58,27 +80,34 @@ def hdf5_NGA_config_write(filename, simname, x, y, z, icyl, iper, mask, endian='
 		ny = y.size - 1
 		nz = z.size - 1
 		parameters = np.array([icyl, iper[0], iper[1], iper[2], nx, ny, nz]).astype(write_type)
-		__oned_attribute_write(group_id, 'parameters', write_type, parameters)
+		_oned_attribute_write(group_id, 'parameters', write_type, parameters)
 
 		# Datasets
-		#-> mask : type integer
-		__dataset_write(group_id, 'mask', write_type, mask)
+		#-> mask : type integer, or bits packed into uint8
+		mask = np.asarray(mask)
+		if (pack_mask and (mask.dtype == bool or np.all((mask == 0) | (mask == 1)))):
+			_oned_attribute_write(group_id, 'mask_packed', write_type, mask.shape)
+			packed_mask = np.packbits(mask.astype(np.uint8).ravel())
+			_dataset_write(group_id, 'mask', h5py.h5t.STD_U8LE, packed_mask, dxpl)
+		else:
+			_dataset_write(group_id, 'mask', write_type, mask, dxpl)
 
 		#-> x, y, z : type float
 		if(endian=='big-endian'):
 			write_type = h5py.h5t.IEEE_F64BE
 		else:
 			write_type = h5py.h5t.IEEE_F64LE
-		__dataset_write(group_id, 'x', write_type, x)
-		__dataset_write(group_id, 'y', write_type, y)
-		__dataset_write(group_id, 'z', write_type, z)
-		__dataset_write(group_id, 'xm', write_type, (x[1:nx] + x[0:nx-1])/2.0)
-		__dataset_write(group_id, 'ym', write_type, (y[1:nx] + y[0:nx-1])/2.0)
-		__dataset_write(group_id, 'zm', write_type, (z[1:nx] + z[0:nx-1])/2.0)
+		_dataset_write(group_id, 'x', write_type, x, dxpl)
+		_dataset_write(group_id, 'y', write_type, y, dxpl)
+		_dataset_write(group_id, 'z', write_type, z, dxpl)
+		_dataset_write(group_id, 'xm', write_type, _midpoints(x), dxpl)
+		_dataset_write(group_id, 'ym', write_type, _midpoints(y), dxpl)
+		_dataset_write(group_id, 'zm', write_type, _midpoints(z), dxpl)
 	finally:
 		fid.close()
 
-def hdf5_NGA_data_write(filename, data, t0, dt, endian='little-endian'):
+def hdf5_NGA_data_write(filename, data, t0, dt, endian='little-endian', compression='gzip', compression_opts=1, comm=None,
+						collective_metadata=True):
 	"""
 		Wrapper function to write data file for NGA simulations in RFML hdf5 convention
 		function is structured in the same manner as matlab function in the RFML matlab repository.
@@ -87,8 +116,21 @@ def hdf5_NGA_data_write(filename, data, t0, dt, endian='little-endian'):
 		data	 : dictonary with key = datafield name, value = data in numpy ndarray
 		t0		 : initial time in time_variables attribute (time_variables[1])
 		dt		 : initial time step in time_variables attribute (time_variables[2])
+		endian	 : 'little-endian' or 'big-endian'
+		compression		 : filter for the chunked datasets ('gzip', 'lzf' or None for contiguous datasets).
+						   'lzf' is faster, but only readable through h5py
+		compression_opts : compression level for 'gzip'
+		comm	 : optional mpi4py communicator. If given, the file is opened with the 'mpio' driver and data
+				   holds the rank-local slab of every field along the slowest varying (first) dimension.
+				   Slabs are stacked in rank order, trailing dimensions must agree, ranks may hold zero rows.
+				   Datasets are contiguous in this case (no compression)
+		collective_metadata : use collective metadata reads and writes when comm is given
 	"""
-	fid = h5py.File(filename, 'w')
+	_invalidate_rfml_cache(filename)
+	if (comm is None):
+		fid = h5py.File(filename, 'w', libver=_HDF5_LIBVER)
+	else:
+		fid = _mpio_file_create(filename, comm, collective_metadata)
 	try:
 		group_id = fid.create_group('/data')
 		# Attributes
@@ -97,31 +139,262 @@ def hdf5_NGA_data_write(filename, data, t0, dt, endian='little-endian'):
 		write_type.set_size(8)
 		write_type.set_strpad(h5py.h5t.STR_SPACEPAD)
 		datafield_names = list(data.keys())
-		__oned_attribute_write(group_id, 'datafield_names', write_type, datafield_names)
+		_oned_attribute_write(group_id, 'datafield_names', write_type, datafield_names)
 		# -> dimensions
 		if(endian=='big-endian'):
 			write_type = h5py.h5t.STD_I32BE
 		else:
 			write_type = h5py.h5t.STD_I32LE
 		nvars = len(datafield_names)
-		data_dims = data[datafield_names[0]].shape
+		data_dims = np.shape(data[datafield_names[0]])
+		if (comm is not None):
+			# global shape and row offset of this rank from the slab sizes of all ranks
+			nrows = comm.allgather(data_dims[0])
+			row_offset = sum(nrows[:comm.rank])
+			data_dims = (sum(nrows),) + tuple(data_dims[1:])
 		dimensions = np.append(np.array(data_dims),nvars)
-		__oned_attribute_write(group_id, 'dimensions', write_type, dimensions)
+		_oned_attribute_write(group_id, 'dimensions', write_type, dimensions)
 		#-> time_variables
 		if (endian == 'big-endian'):
 			write_type = h5py.h5t.IEEE_F64BE
 		else:
 			write_type = h5py.h5t.IEEE_F64LE
 		tvars = np.array([dt, t0])
-		__oned_attribute_write(group_id, 'time_variables', write_type, tvars)
+		_oned_attribute_write(group_id, 'time_variables', write_type, tvars)
 
-		# datasets
+		# datasets : chunked and shuffled before compression, smooth flow fields compress well
+		if (compression != 'gzip'):
+			compression_opts = None
 		for ivar in range(0,nvars):
 			varname = datafield_names[ivar]
-			__dataset_write(group_id, varname, write_type, data[varname])
+			if (comm is not None):
+				_mpio_dataset_write(group_id, varname, write_type, data[varname], row_offset, data_dims)
+				continue
+			data_shape = np.shape(data[varname])
+			if (compression is None):
+				chunks = None
+			else:
+				chunks = _auto_chunks(data_shape, write_type.get_size())
+			dataset = group_id.create_dataset(varname, shape=data_shape, dtype=write_type.dtype, chunks=chunks,
+											  compression=compression, compression_opts=compression_opts,
+											  shuffle=compression is not None)
+			_dataset_fill(dataset, data[varname])
 	finally:
 		fid.close()
 
+def hdf5_read_mask(filename):
+	"""
+		Returns the mask of an NGA config file as integer numpy array,
+		unpacks masks written by hdf5_NGA_config_write with pack_mask=True
+
+		filename : name of config file
+	"""
+	with RfmlHdf5(filename, 'r') as h5:
+		return h5.read_mask()
+
+def flush_repack(filename):
+	"""
+		Reclaims space left behind by hdf5_remove_dataset
+		Does nothing if the file has no pending deletions, or while an RfmlHdf5 handle on it is open
+		(the repack then happens when the last writable handle is closed)
+
+		filename : name of hdf5 file
+	"""
+	key = os.path.abspath(filename)
+	if (key in _PENDING_REPACK and not _OPEN_HANDLES.get(key)):
+		_hdf5_reclaim_space(filename)
+		# only forgotten once the repacked file has replaced the original
+		_PENDING_REPACK.discard(key)
+
+### ====== Batched file access ====== ###
+class RfmlHdf5(object):
+	"""
+		Keeps an hdf5 file open across several operations, so that N edits cost one open/close
+		and a single repack instead of N. Methods mirror the hdf5_* functions of this module
+		without the filename argument, and raise errors instead of printing them.
+
+			with RfmlHdf5('data.h5') as h5:
+				h5.add_dataset('/data', 'T', h5py.h5t.IEEE_F64LE, T)
+				h5.remove_dataset('/data', 'C')
+
+		filename : name of hdf5 file
+		mode	 : 'r' for read only access, 'r+' to modify objects in the file
+		rdcc_nbytes : size of the chunk cache of every dataset opened through this handle
+		rdcc_nslots : number of hash slots of the chunk cache, preferably a prime number
+		rdcc_w0		: chunk preemption policy between 0 and 1, see h5py.File
+
+		The chunk cache is set up once per handle, so batching reads in one RfmlHdf5
+		block amortizes it. Default 64 MiB instead of 1 MiB avoids decompressing the
+		same chunks again on partial reads of large chunked fields.
+	"""
+	def __init__(self, filename, mode='r+', rdcc_nbytes=64*1024*1024, rdcc_nslots=1048583, rdcc_w0=0.75):
+		self.filename = filename
+		self.mode = mode
+		self._fid = None
+		self._key = os.path.abspath(filename)
+		self._repack_pending = False	# objects deleted through this handle
+		self._cache_kwargs = {'rdcc_nbytes': rdcc_nbytes, 'rdcc_nslots': rdcc_nslots, 'rdcc_w0': rdcc_w0}
+
+	def __enter__(self):
+		if (self.mode == 'r'):
+			self._fid = h5py.File(self.filename, 'r', **self._cache_kwargs)
+		else:
+			self._fid = h5py.File(self.filename, self.mode, libver=_HDF5_LIBVER, **self._cache_kwargs)
+		_OPEN_HANDLES[self._key] = _OPEN_HANDLES.get(self._key, 0) + 1
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self._fid.close()
+		self._fid = None
+		_OPEN_HANDLES[self._key] = _OPEN_HANDLES[self._key] - 1
+		if (_OPEN_HANDLES[self._key] == 0):
+			del _OPEN_HANDLES[self._key]
+
+		# reclaim space of everything deleted inside the block at once. Repacking replaces the file,
+		# so it is deferred to the last writable handle if other handles on the file are still open
+		if (self.mode != 'r' and (self._repack_pending or self._key in _PENDING_REPACK)):
+			_PENDING_REPACK.add(self._key)
+			flush_repack(self.filename)
+		return False
+
+	def is_rfml(self):
+		"""
+			Checks the open file against conventions of RFML hdf5 data file, see is_rfml_hdf5
+		"""
+		status = False
+		if ('data' in self._fid):
+			attribute_manager = self._fid['data'].attrs
+			if ('datafield_names' in attribute_manager and 'dimensions' in attribute_manager):
+				status = True
+		return status
+
+	### ====== Attribute methods ====== ###
+	def read_attribute(self, parentpath, attribute_name):
+		"""
+			Returns attribute associated with group or dataset as numpy array
+		"""
+		parent = self._fid.get(parentpath)
+		return np.array(parent.attrs[attribute_name])
+
+	def read_variables(self):
+		"""
+			Returns variable names in group 'data'
+		"""
+		if (self.is_rfml()):
+			varnames = self.read_attribute('/data/', 'datafield_names')
+			# decode in numpy instead of a python loop over the names
+			return varnames.astype(str).tolist()
+		else:
+			raise Exception(self.filename + 'not an RFML hdf5 file')
+
+	def add_attribute(self, parentpath, attribute_name, attribute_type, attribute_data):
+		"""
+			Adds new attribute to the specified location, see hdf5_add_attribute
+		"""
+		parent = self._fid.get(parentpath)
+		if (attribute_name in parent.attrs):
+			raise AttributeError('Attribute already exists! please use hdf5_replace_attribute method instead')
+		_oned_attribute_write(parent, attribute_name, attribute_type, attribute_data)
+
+	def replace_attribute(self, parentpath, attribute_name, attribute_data):
+		"""
+			Replaces an existing attribute at the specified location, see hdf5_replace_attribute
+		"""
+		parent = self._fid.get(parentpath)
+		attribute_manager = parent.attrs
+		if (attribute_name not in attribute_manager):
+			raise AttributeError('Attribute does not exists! please use hdf5_add_attribute method instead')
+
+		# only a few header bytes are freed by a grown attribute, not worth a repack of the file
+		_attribute_replace(parent, attribute_name, attribute_data)
+		_invalidate_rfml_cache(self.filename)
+
+	### ====== Dataset methods ====== ###
+	def add_dataset(self, parentpath, dataset_name, data_type, dataset_data):
+		"""
+			Adds a new dataset and updates the attributes 'dimensions' and 'datafield_names'
+		"""
+		assert(self.is_rfml())
+		parent = self._fid.get(parentpath)
+		_dataset_write(parent, dataset_name, data_type, dataset_data)
+
+		# Change attributes 'dimensions' and 'datafield_names'
+		attribute_manager = parent.attrs
+		variable_names = np.array(attribute_manager['datafield_names'])
+		new_names = np.empty(variable_names.size + 1, dtype=variable_names.dtype)
+		new_names[:-1] = variable_names
+		new_names[-1] = np.asarray(dataset_name, dtype=variable_names.dtype)
+		dimensions = np.array(attribute_manager['dimensions'])
+		dimensions[3] = dimensions[3] + 1
+
+		# 'dimensions' keeps its size and is overwritten in place, no repack needed for either
+		_attribute_replace(parent, 'datafield_names', new_names)
+		_attribute_replace(parent, 'dimensions', dimensions)
+		_invalidate_rfml_cache(self.filename)
+
+	def remove_dataset(self, parentpath, dataset_name):
+		"""
+			Removes a dataset and, for RFML files, updates the attributes 'dimensions' and 'datafield_names'
+		"""
+		parent = self._fid.get(parentpath)
+		if (dataset_name not in parent):
+			raise NameError("dataset " + dataset_name + " does not exist")
+
+		del parent[dataset_name]
+		_invalidate_rfml_cache(self.filename)
+
+		# change attributes if rfml_hdf5 file, in memory and on the same handle
+		attribute_manager = parent.attrs
+		if ('datafield_names' in attribute_manager and 'dimensions' in attribute_manager):
+			# datafield_names
+			dataset_names = np.array(attribute_manager['datafield_names'])
+			idx = np.where(dataset_names.astype(str) == dataset_name)[0][0]
+			dataset_names = np.delete(dataset_names, idx)
+			# dimensions
+			dimensions = np.array(attribute_manager['dimensions'])
+			dimensions[3] = dimensions[3] - 1
+
+			_attribute_replace(parent, 'datafield_names', dataset_names)
+			_attribute_replace(parent, 'dimensions', dimensions)
+
+		# one repack for the dataset and both attributes, when the file is closed
+		self._repack_pending = True
+
+	def read_dataset(self, parentpath, dataset_name, out=None):
+		"""
+			Reads a dataset and returns as numpy ndarray, see hdf5_read_dataset
+		"""
+		dataset = self._fid.get(parentpath)[dataset_name]
+		if (out is None):
+			out = np.empty(dataset.shape, dtype=dataset.dtype)
+		if (dataset.size > 0):
+			dataset.read_direct(out)
+		return out
+
+	def read_mask(self):
+		"""
+			Returns the mask of an NGA config file as integer numpy array, see hdf5_read_mask
+		"""
+		mask = self.read_dataset('/data', 'mask')
+		if ('mask_packed' in self._fid['data'].attrs):
+			shape = tuple(self.read_attribute('/data', 'mask_packed'))
+			mask = np.unpackbits(mask)[:int(np.prod(shape))].reshape(shape).astype(np.int32)
+		return mask
+
+	def overwrite_dataset(self, parentpath, dataset_name, new_dataset):
+		"""
+			Overwrites an existing dataset with new data, does not check for shape consistency
+		"""
+		self._fid.get(parentpath)[dataset_name][...] = new_dataset
+
+	def get_dataset_type(self, group_path, dataset_name):
+		"""
+			Returns native hdf5 datatype of a dataset
+		"""
+		group_obj_id = self._fid.get(group_path).id
+		dataset_obj_id = h5py.h5d.open(group_obj_id, _convert_name(dataset_name))
+		return dataset_obj_id.get_type()
+
 ### ====== Attribute functions ====== ###
 def hdf5_read_attribute(filename, parentpath, attribute_name):
 	"""
@@ -133,24 +406,16 @@ def hdf5_read_attribute(filename, parentpath, attribute_name):
 
 		return type numpy array, since attributes are one dimensional
 	"""
-	# Returns contents of attribute of a group
-	fid = h5py.File(filename, 'r')
-	parent = fid.get(parentpath)
-	attribute_data = np.array(parent.attrs[attribute_name])
-	fid.close()
-	return attribute_data
+	with RfmlHdf5(filename, 'r') as h5:
+		return h5.read_attribute(parentpath, attribute_name)
 
 
 def hdf5_read_variables(filename):
 	"""
 		Returns variable names in group 'data'
 	"""
-	if (is_rfml_hdf5(filename)):
-		varnames = hdf5_read_attribute(filename, '/data/', 'datafield_names')
-		varnames = [x.decode('utf-8') for x in varnames]
-		return varnames
-	else:
-		raise Exception(filename + 'not an RFML hdf5 file')
+	with RfmlHdf5(filename, 'r') as h5:
+		return h5.read_variables()
 
 
 def hdf5_add_attribute(filename, parentpath, attribute_name, attribute_type, attribute_data):
@@ -164,24 +429,17 @@ def hdf5_add_attribute(filename, parentpath, attribute_name, attribute_type, att
 						 must contain all necessary info, such as string type with necessary padding and length
 		attribute_data : numpy array with attribute data to be written
 	"""
-	fid = h5py.File(filename, 'r+')
-	try:
-		parent = fid.get(parentpath)
-		attribute_manager = parent.attrs
-
-		if (attribute_name in list(attribute_manager)):
-			raise AttributeError('Attribute already exists! please use hdf5_replace_attribute method instead')
-		else:
-			__oned_attribute_write(parent, attribute_name, attribute_type, attribute_data)
-	except Exception as err:
-		print(err)
-	finally:
-		fid.close()
+	with RfmlHdf5(filename) as h5:
+		try:
+			h5.add_attribute(parentpath, attribute_name, attribute_type, attribute_data)
+		except Exception as err:
+			print(err)
 
 
 def hdf5_replace_attribute(filename, parentpath, attribute_name, attribute_data):
 	"""
-		Adds new attribute to the specified location
+		Replaces an existing attribute at the specified location
+		Attributes of the same size are overwritten in place, the file is never repacked
 
 		filename : Name of hdf5 file
 		parentpath : path of the parent group or dataset to which the attribute is attached
@@ -190,52 +448,23 @@ def hdf5_replace_attribute(filename, parentpath, attribute_name, attribute_data)
 						 must contain all necessary info, such as string type with necessary padding and length
 		attribute_data : numpy array with attribute data to be written
 	"""
-	fid = h5py.File(filename, 'r+')
-	parent = fid.get(parentpath)
-	attribute_manager = parent.attrs
-
-	try:
-		if (attribute_name in list(attribute_manager)):
-			# attribute type - copy from old attribute
-			attribute_id = attribute_manager.get_id(attribute_name)
-			attribute_type = attribute_id.get_type()
-
-			# delete old attribute and replace with new one
-			del attribute_manager[attribute_name]
-			__oned_attribute_write(parent, attribute_name, attribute_type, np.array(attribute_data))
-
-			fid.close()
-			__hdf5_reclaim_space(filename)
-		else:
-			raise AttributeError('Attribute does not exists! please use hdf5_add_attribute method instead')
-	except Exception as err:
-		fid.close()
-		print(err)
+	with RfmlHdf5(filename) as h5:
+		try:
+			h5.replace_attribute(parentpath, attribute_name, attribute_data)
+		except Exception as err:
+			print(err)
 
 ### ====== Dataset functions ====== ###
 def hdf5_add_dataset(filename, parentpath, dataset_name, data_type, dataset_data):
 	"""
 		Adds a new dataset to existing hdf5 file
 	"""
-	assert(is_rfml_hdf5(filename))
-	fid = h5py.File(filename, 'r+')
-	try:
-		# Write dataset
-		parent = fid.get(parentpath)
-		__dataset_write(parent, dataset_name, data_type, dataset_data)
-
-		# Change attributes 'dimensions' and 'datafield_names'
-		variable_names = hdf5_read_variables(filename)
-		variable_names = np.append(variable_names, np.array([dataset_name]).astype(type(variable_names)))
-		dimensions = hdf5_read_attribute(filename, parentpath, 'dimensions')
-		dimensions[3] = dimensions[3] + 1
-		fid.close()
-
-		hdf5_replace_attribute(filename, parentpath, 'datafield_names', variable_names)
-		hdf5_replace_attribute(filename, parentpath, 'dimensions', dimensions)
-	except Exception as err:
-		print(err)
-		fid.close()
+	with RfmlHdf5(filename) as h5:
+		assert(h5.is_rfml())
+		try:
+			h5.add_dataset(parentpath, dataset_name, data_type, dataset_data)
+		except Exception as err:
+			print(err)
 
 def hdf5_remove_dataset(filename, parentpath, dataset_name):
 	"""
@@ -245,52 +474,29 @@ def hdf5_remove_dataset(filename, parentpath, dataset_name):
 		filename: path to the hdf5 file
 		parentpath: path to group which contains the dataset
 		datafield_name: name of the dataset to be remmoved
-	"""
-	fid = h5py.File(filename,'r+')
-	parent = fid.get(parentpath)
-
-	try:
-		if(dataset_name in list(parent)):
-			del parent[dataset_name]
-
-			# change attributes if rfml_hdf5 file
-			if(is_rfml_hdf5(filename)):
-				attribute_manager = parent.attrs
-				# datafield_names
-				dataset_names = attribute_manager['datafield_names']
-				dataset_names_str = [x.decode('UTF-8') for x in dataset_names]
-				idx = dataset_names_str.index(dataset_name)
-				dataset_names = np.delete(dataset_names, idx)
-				# dimensions
-				dimensions = attribute_manager['dimensions']
-				dimensions[3] = dimensions[3] - 1
-
-			fid.close()
-			__hdf5_reclaim_space(filename)
-
-			# replace attributes
-			if(is_rfml_hdf5(filename)):
-				hdf5_replace_attribute(filename, parentpath, 'datafield_names', dataset_names)
-				hdf5_replace_attribute(filename, parentpath, 'dimensions', dimensions)
 
-		else:
-			raise NameError("dataset " + datafield_name + "does not exist")
-	except Exception as err:
-		print(err)
-		fid.close()
-
-def hdf5_read_dataset(filename, parentpath, dataset_name):
+		Space of the removed dataset is reclaimed when the file is closed
+	"""
+	with RfmlHdf5(filename) as h5:
+		try:
+			h5.remove_dataset(parentpath, dataset_name)
+		except Exception as err:
+			print(err)
+
+def hdf5_read_dataset(filename, parentpath, dataset_name, out=None, rdcc_nbytes=64*1024*1024, rdcc_nslots=1048583,
+					  rdcc_w0=0.75):
 	"""
 		Reads a dataset and returns as numpy ndarray
 
 		filename: name of hdf5 file
 		parentpath: path of group that contains the dataset
 		dataset_name : name of the dataset to be read
+		out : optional C-contiguous array of the dataset shape that is filled in place and returned,
+			  saves allocating a new array when reading many datasets of the same shape
+		rdcc_nbytes, rdcc_nslots, rdcc_w0 : chunk cache size, number of slots and preemption policy, see RfmlHdf5
 	"""
-	fid = h5py.File(filename, 'r')
-	field = np.array(fid.get(parentpath)[dataset_name])
-	fid.close()
-	return field
+	with RfmlHdf5(filename, 'r', rdcc_nbytes=rdcc_nbytes, rdcc_nslots=rdcc_nslots, rdcc_w0=rdcc_w0) as h5:
+		return h5.read_dataset(parentpath, dataset_name, out)
 
 def hdf5_overwrite_dataset(filename, parentpath, dataset_name, new_dataset):
 	"""
@@ -302,13 +508,8 @@ def hdf5_overwrite_dataset(filename, parentpath, dataset_name, new_dataset):
 		dataset_name: name of the dataset to be overwritten
 		new_dataset: new data to be written
 	"""
-	fid = h5py.File(filename, 'r+')
-	try:
-		group_id = fid.get(parentpath)
-		data_id = group_id[dataset_name]
-		data_id[...] = new_dataset
-	finally:
-		fid.close()
+	with RfmlHdf5(filename) as h5:
+		h5.overwrite_dataset(parentpath, dataset_name, new_dataset)
 
 def hdf5_get_dataset_type(filename, group_path, dataset_name):
 	"""
@@ -318,23 +519,19 @@ def hdf5_get_dataset_type(filename, group_path, dataset_name):
 		group_path : path inside the file of the containing group ('/' if no group)
 		dataset_name : name of the dataset
 	"""
-	fid = h5py.File(filename, 'r')
 	datatype_id = None
-	try:
-		group_obj_id = fid.get(group_path).id
-		dataset_obj_id = h5py.h5d.open(group_obj_id, __convert_name(dataset_name))
-		datatype_id = dataset_obj_id.get_type()
-	except Exception as err:
-		print(err)
-	finally:
-		fid.close()
-		return datatype_id
+	with RfmlHdf5(filename, 'r') as h5:
+		try:
+			datatype_id = h5.get_dataset_type(group_path, dataset_name)
+		except Exception as err:
+			print(err)
+	return datatype_id
 
 ### === Private functions === ###
-def __oned_attribute_write(parent, attribute_name, write_type, attribute_data):
+def _oned_attribute_write(parent, attribute_name, write_type, attribute_data):
 	"""
 		Private method that writes attribute to group
-		- Uses low level h5py API
+		- Uses high level h5py API, low level API only for string types to keep their padding
 		- Access through public methods 'hdf5_NGA_data_write', 'hdf5_NGA_config_write', or 'hdf5_add_attribute'
 
 		parent : high level identifier for parent group/dataset to which attribute is to be attached
@@ -342,17 +539,49 @@ def __oned_attribute_write(parent, attribute_name, write_type, attribute_data):
 		write_type : hdf5 type in which attribute is to be written
 		attribute_data : attribute data - must be convertible to numpy.ndarray
 	"""
-	parent_id = parent.id
-	dimensions = (np.array(attribute_data).size,)	# tuple
-	space_id = h5py.h5s.create_simple(dimensions, dimensions)
-	attribute_id = h5py.h5a.create(parent_id, __convert_name(attribute_name), write_type, space_id)
-	attribute_id.write(np.array(attribute_data).astype(write_type))
-	attribute_id.close()
+	attribute_array = np.asarray(attribute_data)	# convert once, reused below
+	dimensions = (attribute_array.size,)	# tuple
+	if (isinstance(write_type, h5py.h5t.TypeStringID)):
+		space_id = h5py.h5s.create_simple(dimensions, dimensions)
+		attribute_id = h5py.h5a.create(parent.id, _convert_name(attribute_name), write_type, space_id)
+		attribute_id.write(np.ascontiguousarray(attribute_array.astype(write_type, copy=False)))
+		attribute_id.close()
+	else:
+		parent.attrs.create(attribute_name, attribute_array.astype(write_type.dtype, copy=False).reshape(dimensions),
+							shape=dimensions, dtype=write_type.dtype)
+
+def _attribute_replace(parent, attribute_name, attribute_data):
+	"""
+		Private method that replaces an existing attribute, keeping its old hdf5 type
+		- Same number of elements: written in place with the low level h5py API (H5Awrite)
+		- Otherwise the old attribute is deleted and written again
+		- Accessed through RfmlHdf5 methods 'replace_attribute', 'add_dataset' and 'remove_dataset'
+
+		parent : high level identifier for parent group/dataset the attribute is attached to
+		attribute_name : name of the attribute to be replaced
+		attribute_data : new attribute data - must be convertible to numpy.ndarray
+	"""
+	attribute_manager = parent.attrs
+	attribute_array = np.asarray(attribute_data)
+	attribute_id = attribute_manager.get_id(attribute_name)
+	if (attribute_array.size == int(np.prod(attribute_id.shape))):
+		attribute_id.write(np.ascontiguousarray(attribute_array.reshape(attribute_id.shape).astype(attribute_id.dtype)))
+		return
 
-def __dataset_write(parent, dataset_name, write_type, write_data):
+	# attribute type - copy from old attribute
+	attribute_type = attribute_id.get_type()
+
+	# delete old attribute and replace with new one
+	del attribute_manager[attribute_name]
+	_oned_attribute_write(parent, attribute_name, attribute_type, attribute_array)
+
+def _dataset_write(parent, dataset_name, write_type, write_data, dxpl=None, compression='gzip', compression_opts=1,
+				   shuffle=True):
 	"""
 		Private method to write dataset
-		- Uses low level h5py API
+		- Uses low level h5py API for small datasets, contiguous and uncompressed
+		- Datasets of 1 MiB or more are chunked (~1 MiB chunks, see _auto_chunks) and compressed
+		  through the high level h5py API, which sets up the filter pipeline
 		- Accessed by public methods 'hdf5_add_field', 'hdf5_NGA_data_write'
 
 		parent: high level group reference where dataset is to be added.
@@ -360,21 +589,203 @@ def __dataset_write(parent, dataset_name, write_type, write_data):
 		dataset_name : Name of the dataset
 		write_type	: data type
 		write_data	: data to be written, must be convertible to nparray
+		dxpl	: optional dataset transfer property list, e.g. from _mpio_collective_dxpl.
+				  Datasets written with a dxpl are never compressed
+		compression	: filter for large datasets ('gzip', 'lzf' or None)
+		compression_opts : compression level for 'gzip'
+		shuffle	: apply the shuffle filter before compression
 	"""
 	parent_id = parent.id
-	dimensions = np.array(write_data).shape
+	write_array = np.ascontiguousarray(write_data)	# convert once, reused below
+	dimensions = write_array.shape
+	write_nbytes = write_array.size * write_type.get_size()
+	if (compression is not None and dxpl is None and write_nbytes >= 1024*1024):
+		if (compression != 'gzip'):
+			compression_opts = None
+		dataset = parent.create_dataset(dataset_name, shape=dimensions, dtype=write_type.dtype,
+										chunks=_auto_chunks(dimensions, write_type.get_size()), compression=compression,
+										compression_opts=compression_opts, shuffle=shuffle)
+		# converted once to the file type, written without further copies
+		dataset.write_direct(np.ascontiguousarray(write_array.astype(write_type.dtype, copy=False)))
+		return
+
 	space_id = h5py.h5s.create_simple(dimensions, dimensions)
-	data_id = h5py.h5d.create(parent_id, __convert_name(dataset_name), write_type, space_id)
-	data_id.write(h5py.h5s.ALL, space_id, np.array(write_data).astype(write_type), write_type)
+	data_id = h5py.h5d.create(parent_id, _convert_name(dataset_name), write_type, space_id)
+	# no copy if the data is already stored in write_type
+	data_id.write(h5py.h5s.ALL, space_id, write_array.astype(write_type, copy=False), write_type, dxpl=dxpl)
+
+def _dataset_fill(dataset, write_data):
+	"""
+		Private method that writes the full contents of an existing dataset
+		- Accessed by public method 'hdf5_NGA_data_write'
 
+		dataset : high level dataset reference
+		write_data : data to be written, must be convertible to nparray of the dataset shape
+	"""
+	if (dataset.size > 0):
+		# converted once to the file type, written without further copies
+		dataset.write_direct(np.ascontiguousarray(np.asarray(write_data).astype(dataset.dtype, copy=False)))
 
-def __hdf5_reclaim_space(filename):
+def _mpio_file_create(filename, comm, collective_metadata=True):
+	"""
+		Private method that creates (truncates) a file with the 'mpio' driver on all ranks of comm
+		- Collective metadata ops replace the many small independent metadata reads/writes of each rank
+
+		filename : name of hdf5 file
+		comm : mpi4py communicator
+		collective_metadata : enable collective metadata reads and writes
+	"""
+	from mpi4py import MPI
+	fapl = h5py.h5p.create(h5py.h5p.FILE_ACCESS)
+	fapl.set_fapl_mpio(comm, MPI.INFO_NULL)
+	libver = getattr(h5py.h5f, 'LIBVER_' + _HDF5_LIBVER.upper())
+	fapl.set_libver_bounds(libver, h5py.h5f.LIBVER_LATEST)
+	if (collective_metadata):
+		fapl.set_all_coll_metadata_ops(True)
+		fapl.set_coll_metadata_write(True)
+	file_id = h5py.h5f.create(_convert_name(filename), h5py.h5f.ACC_TRUNC, fapl=fapl)
+	return h5py.File(file_id)
+
+def _mpio_collective_dxpl():
+	"""
+		Private method that returns a dataset transfer property list for collective MPI-IO writes
+	"""
+	dxpl = h5py.h5p.create(h5py.h5p.DATASET_XFER)
+	dxpl.set_dxpl_mpio(h5py.h5fd.MPIO_COLLECTIVE)
+	return dxpl
+
+def _mpio_dataset_write(parent, dataset_name, write_type, local_data, row_offset, global_shape):
+	"""
+		Private method to write dataset from all ranks of a file opened with the 'mpio' driver
+		- Dataset is created collectively, then each rank writes its slab of the first dimension
+		- All ranks take part in the collective write, ranks without rows with an empty selection
+		- Accessed by public method 'hdf5_NGA_data_write'
+
+		parent: high level group reference where dataset is to be added
+		dataset_name : Name of the dataset
+		write_type	: data type
+		local_data	: slab of this rank, rows row_offset to row_offset + local_data.shape[0] of the dataset
+		row_offset	: first row of the slab in the dataset
+		global_shape : shape of the full dataset, identical on all ranks
+	"""
+	dataset = parent.create_dataset(dataset_name, shape=global_shape, dtype=write_type.dtype)
+	local_array = np.ascontiguousarray(np.asarray(local_data).astype(dataset.dtype, copy=False))
+	file_space = dataset.id.get_space()
+	mem_space = h5py.h5s.create_simple(local_array.shape)
+	if (local_array.size > 0):
+		file_space.select_hyperslab((row_offset,) + (0,)*(local_array.ndim - 1), local_array.shape)
+	else:
+		file_space.select_none()
+		mem_space.select_none()
+	dataset.id.write(mem_space, file_space, local_array, dxpl=_mpio_collective_dxpl())
+
+def _midpoints(a):
+	"""
+		Private method that returns cell centers 0.5*(a[1:] + a[:-1]) of the cell face array a
+		- Sums into a preallocated buffer, compiled loop with numba for very large arrays if available
+	"""
+	if (a.dtype.kind == 'f'):
+		out = np.empty(a.size - 1, dtype=a.dtype)
+	else:
+		out = np.empty(a.size - 1, dtype=np.float64)
+	kernel = None
+	if (out.size >= _NUMBA_MIN_SIZE):
+		kernel = _midpoints_numba()
+	if (kernel is not None):
+		kernel(np.ascontiguousarray(a), out)
+	else:
+		np.add(a[1:], a[:-1], out=out)
+		out *= 0.5
+	return out
+
+def _midpoints_kernel(a, out):
+	"""
+		Private loop of _midpoints compiled by numba, writes the cell centers of a into out
+	"""
+	for i in range(out.size):
+		out[i] = 0.5*(a[i+1] + a[i])
+
+def _midpoints_numba():
+	"""
+		Private method that imports numba and compiles _midpoints_kernel on first use
+		returns the compiled kernel, or None if numba is not available
+	"""
+	global _MIDPOINTS_NB
+	if (_MIDPOINTS_NB is None):
+		try:
+			from numba import njit
+			_MIDPOINTS_NB = njit(cache=True, fastmath=True)(_midpoints_kernel)
+		except ImportError:
+			_MIDPOINTS_NB = False
+	return _MIDPOINTS_NB or None
+
+def _auto_chunks(shape, itemsize, chunk_nbytes=1024*1024):
+	"""
+		Private method that returns a chunk shape of about chunk_nbytes (1 MiB, see HDF5 chunking guide)
+		- Halves the slowest varying dimensions first, so that chunks stay contiguous in memory
+
+		shape : shape of the dataset
+		itemsize : size of one element in bytes
+		chunk_nbytes : target size of one chunk in bytes
+	"""
+	if (0 in shape):
+		return True		# let h5py guess for empty datasets
+	chunks = list(shape)
+	idim = 0
+	while (np.prod(chunks) * itemsize > chunk_nbytes and idim < len(chunks)):
+		if (chunks[idim] > 1):
+			chunks[idim] = (chunks[idim] + 1) // 2
+		else:
+			idim = idim + 1
+	return tuple(chunks)
+
+def _hdf5_reclaim_space(filename):
 	"""
 		Private method that reclaims empty space of hdf5 file created by deleting objects inside
+		- Rewrites all objects to a temporary file in-process and replaces the original
+		- Not needed as often with _HDF5_LIBVER = 'latest', where freed metadata space is reused
+	"""
+	temp_filename = filename + '.repack'
+	try:
+		src = h5py.File(filename, 'r')
+		try:
+			dst = h5py.File(temp_filename, 'w', libver=_HDF5_LIBVER)
+			try:
+				for name in src:
+					# soft and external links stay links, only hard links are copied
+					link = src.get(name, getlink=True)
+					if (isinstance(link, h5py.SoftLink)):
+						dst[name] = h5py.SoftLink(link.path)
+					elif (isinstance(link, h5py.ExternalLink)):
+						dst[name] = h5py.ExternalLink(link.filename, link.path)
+					else:
+						src.copy(name, dst, name=name)
+				# root attributes are not carried over by copy, keep their original types
+				for name in src.attrs:
+					attribute_id = src.attrs.get_id(name)
+					attribute_data = np.empty(attribute_id.shape, dtype=attribute_id.dtype)
+					attribute_id.read(attribute_data)
+					new_id = h5py.h5a.create(dst.id, _convert_name(name), attribute_id.get_type(), attribute_id.get_space())
+					new_id.write(attribute_data)
+					new_id.close()
+			finally:
+				dst.close()
+		finally:
+			src.close()
+		os.replace(temp_filename, filename)
+	finally:
+		# left behind only if the repack failed
+		if (os.path.exists(temp_filename)):
+			os.remove(temp_filename)
+	_invalidate_rfml_cache(filename)
+
+def _invalidate_rfml_cache(filename):
+	"""
+		Private method that drops cached is_rfml_hdf5 results of a file that is being modified
 	"""
-	# repack to temp file
-	cmd = "h5repack -i " + filename + "-o temp.h5 && mv temp.h5 " + filename
-	os.system(cmd)
+	_RFML_CACHE.pop(filename, None)
 
-def __convert_name(string_to_convert):
-	return bytes(string_to_convert, encoding='utf-8')
\ No newline at end of file
+@functools.lru_cache(maxsize=1024)
+def _convert_name(string_to_convert):
+	# cached, the same few names ('x', 'dimensions', ...) are encoded over and over
+	return string_to_convert.encode('utf-8')
\ No newline at end of file
@@ -1,6 +1,7 @@
 import sys
 import unittest
 import numpy.testing as npt
+import rfml_hdf5
 from rfml_hdf5 import *
 
 
@@ -30,6 +31,36 @@ class TestHdf5Functions(unittest.TestCase):
 		self.assertTrue(is_rfml_hdf5(self.sample_file))
 		self.assertListEqual(hdf5_read_variables(self.sample_file), list(h5py.File(self.sample_file)['data']))
 
+	def test_is_rfml_hdf5_cache_invalidated_on_write(self):
+		self.assertFalse(is_rfml_hdf5(self.generic_file))
+		self.assertEqual(rfml_hdf5._RFML_CACHE[self.generic_file][1], False)
+
+		# a stale entry at the current mtime is only dropped by invalidation
+		rfml_hdf5._RFML_CACHE[self.sample_file] = (os.stat(self.sample_file).st_mtime_ns, False)
+		self.assertFalse(is_rfml_hdf5(self.sample_file))
+		hdf5_replace_attribute(self.sample_file, '/data', 'time_variables', [2.468E-04, 4.712E-07])
+		self.assertNotIn(self.sample_file, rfml_hdf5._RFML_CACHE)
+		self.assertTrue(is_rfml_hdf5(self.sample_file))
+
+		rfml_hdf5._RFML_CACHE[self.generic_file] = (os.stat(self.generic_file).st_mtime_ns, True)
+		hdf5_NGA_data_write(self.generic_file, {'C': np.zeros(self.dataset_dims)}, 0, 2E-07)
+		self.assertNotIn(self.generic_file, rfml_hdf5._RFML_CACHE)
+
+	def test_hdf5_libver(self):
+		# superblock version 0 is the legacy format written with libver 'earliest'
+		fid = h5py.File(self.sample_file, 'r')
+		self.assertGreater(fid.id.get_create_plist().get_version()[0], 0)
+		fid.close()
+
+		rfml_hdf5._HDF5_LIBVER = 'earliest'
+		try:
+			hdf5_NGA_data_write(self.sample_file, {'C': np.zeros(self.dataset_dims)}, 0, 2E-07)
+		finally:
+			rfml_hdf5._HDF5_LIBVER = 'latest'
+		fid = h5py.File(self.sample_file, 'r')
+		self.assertEqual(fid.id.get_create_plist().get_version()[0], 0)
+		fid.close()
+
 	# === ATTRIBUTE TESTS === #
 	def test_hdf5_read_attribute(self):
 		self.assertListEqual(list(hdf5_read_attribute(self.sample_file, '/data', 'dimensions')), [10, 10, 10, 1])
@@ -46,6 +77,20 @@ class TestHdf5Functions(unittest.TestCase):
 		self.assertTrue(np.array_equal(hdf5_read_attribute(self.sample_file, '/data', 'time_variables'),
 									   np.array([2.468E-04, 4.712E-07])))
 
+	def test_hdf5_attribute_edits_skip_repack(self):
+		with RfmlHdf5(self.sample_file) as h5:
+			h5.replace_attribute('/data', 'time_variables', [2.468E-04, 4.712E-07])
+			h5.replace_attribute('/data', 'time_variables', [2.468E-04, 4.712E-07, 1.0])
+			h5.add_dataset('/data', 'T', h5py.h5t.IEEE_F64LE, np.zeros(self.dataset_dims))
+			self.assertFalse(h5._repack_pending)
+			h5.remove_dataset('/data', 'T')
+			self.assertTrue(h5._repack_pending)
+
+		# grows 'datafield_names' again after the last dataset was removed
+		hdf5_remove_dataset(self.sample_file, '/data', 'C')
+		hdf5_add_dataset(self.sample_file, '/data', 'T', h5py.h5t.IEEE_F64LE, np.zeros(self.dataset_dims))
+		self.assertListEqual(hdf5_read_variables(self.sample_file), ['T'])
+
 	def test_hdf5_add_dataset(self):
 		random_dataset = np.random.random_sample(self.dataset_dims)
 		hdf5_add_dataset(self.sample_file, '/data', 'T', h5py.h5t.IEEE_F64LE, random_dataset)
@@ -61,15 +106,104 @@ class TestHdf5Functions(unittest.TestCase):
 		self.assertEqual((fid['data'].attrs['dimensions'])[3], 2)
 		fid.close()
 
+	def test_hdf5_add_dataset_compressed(self):
+		# 2 MiB dataset, above the size from which datasets are compressed
+		random_dataset = np.random.random_sample((64, 64, 64))
+		hdf5_add_dataset(self.sample_file, '/data', 'T', h5py.h5t.IEEE_F64LE, random_dataset)
+		npt.assert_array_equal(hdf5_read_dataset(self.sample_file, '/data', 'T'), random_dataset)
+		fid = h5py.File(self.sample_file, 'r')
+		self.assertEqual(fid['data']['T'].compression, 'gzip')
+		fid.close()
+
 	# === DATASET TESTS === #
 	def test_hdf5_remove_dataset(self):
 		hdf5_remove_dataset(self.sample_file, '/data', 'C')
 		fid = h5py.File(self.sample_file, 'r')
-		self.assertTrue('C' not in list(fid['data'].attrs['datafield_names']))
+		self.assertTrue('C' not in list(fid['data'].attrs['datafield_names'].astype('str')))
 		self.assertTrue('C' not in list(fid['data']))
 		self.assertEqual((fid['data'].attrs['dimensions'])[3], 0)
 		fid.close()
 
+	def test_flush_repack(self):
+		random_dataset = np.random.random_sample(self.dataset_dims)
+		hdf5_add_dataset(self.sample_file, '/data', 'D', h5py.h5t.IEEE_F64LE, random_dataset)
+		size_before = os.path.getsize(self.sample_file)
+		key = os.path.abspath(self.sample_file)
+
+		# pending while a handle is open: flush_repack must not replace the open file
+		with RfmlHdf5(self.sample_file) as h5:
+			hdf5_remove_dataset(self.sample_file, '/data', 'C')
+			self.assertIn(key, rfml_hdf5._PENDING_REPACK)
+			flush_repack(self.sample_file)
+			self.assertIn(key, rfml_hdf5._PENDING_REPACK)
+			h5.add_attribute('/data', 'temp_attr', h5py.h5t.IEEE_F64LE, [1.234E-04])
+		self.assertNotIn(key, rfml_hdf5._PENDING_REPACK)
+		self.assertLess(os.path.getsize(self.sample_file), size_before)
+		npt.assert_array_equal(hdf5_read_attribute(self.sample_file, '/data', 'temp_attr'), [1.234E-04])
+
+		# pending on a closed file
+		size_before = os.path.getsize(self.sample_file)
+		fid = h5py.File(self.sample_file, 'r+')
+		del fid['data']['D']
+		fid.close()
+		rfml_hdf5._PENDING_REPACK.add(key)
+		flush_repack(self.sample_file)
+		self.assertNotIn(key, rfml_hdf5._PENDING_REPACK)
+		self.assertLess(os.path.getsize(self.sample_file), size_before)
+		self.assertTrue(is_rfml_hdf5(self.sample_file))
+		npt.assert_array_almost_equal(hdf5_read_attribute(self.sample_file, '/data', 'time_variables'),
+									  np.array([2E-07, 0.0]), 16)
+
+	def test_flush_repack_keeps_root_links(self):
+		link_file = 'links_hdf5.h5'
+		external_file = 'external_hdf5.h5'
+		fid = h5py.File(external_file, 'w')
+		fid.create_dataset('big', data=np.zeros(self.dataset_dims))
+		fid.close()
+		fid = h5py.File(link_file, 'w')
+		fid.create_dataset('A', data=np.arange(4))
+		fid.create_dataset('B', data=np.zeros(self.dataset_dims))
+		fid['soft'] = h5py.SoftLink('/A')
+		fid['dangling'] = h5py.SoftLink('/missing')
+		fid['ext'] = h5py.ExternalLink(external_file, '/big')
+		fid.close()
+		try:
+			hdf5_remove_dataset(link_file, '/', 'B')
+			self.assertNotIn(os.path.abspath(link_file), rfml_hdf5._PENDING_REPACK)
+			self.assertFalse(os.path.exists(link_file + '.repack'))
+
+			fid = h5py.File(link_file, 'r')
+			self.assertListEqual(sorted(fid.keys()), ['A', 'dangling', 'ext', 'soft'])
+			self.assertEqual(fid.get('soft', getlink=True).path, '/A')
+			self.assertEqual(fid.get('dangling', getlink=True).path, '/missing')
+			external_link = fid.get('ext', getlink=True)
+			self.assertIsInstance(external_link, h5py.ExternalLink)
+			self.assertEqual((external_link.filename, external_link.path), (external_file, '/big'))
+			npt.assert_array_equal(fid['soft'][...], np.arange(4))
+			fid.close()
+			self.assertLess(os.path.getsize(link_file), os.path.getsize(external_file))
+		finally:
+			os.system('rm -f ' + link_file + ' ' + external_file)
+
+	def test_flush_repack_failure_stays_pending(self):
+		key = os.path.abspath(self.generic_file)
+		open(self.generic_file, 'w').close()	# not an hdf5 file, repack fails
+		rfml_hdf5._PENDING_REPACK.add(key)
+		try:
+			self.assertRaises(OSError, flush_repack, self.generic_file)
+			self.assertIn(key, rfml_hdf5._PENDING_REPACK)
+			self.assertFalse(os.path.exists(self.generic_file + '.repack'))
+		finally:
+			rfml_hdf5._PENDING_REPACK.discard(key)
+
+	def test_hdf5_read_dataset_into_buffer(self):
+		new_data = np.random.random_sample(self.dataset_dims)
+		hdf5_overwrite_dataset(self.sample_file, '/data', 'C', new_data)
+		out = np.empty(self.dataset_dims)
+		read_data = hdf5_read_dataset(self.sample_file, '/data', 'C', out=out)
+		self.assertIs(read_data, out)
+		npt.assert_array_equal(out, new_data)
+
 	def test_hdf5_overwrite_dataset(self):
 		new_data = np.random.random_sample(self.dataset_dims)
 		new_data = new_data.astype(h5py.h5t.IEEE_F32BE)
@@ -82,6 +216,41 @@ class TestHdf5Functions(unittest.TestCase):
 		new_type = hdf5_get_dataset_type(self.sample_file, 'data', 'C')
 		self.assertEqual(new_type, h5py.h5t.IEEE_F64LE)
 
+	# === BATCHED ACCESS TESTS === #
+	def test_rfml_hdf5_batched_edits(self):
+		random_dataset = np.random.random_sample(self.dataset_dims)
+		with RfmlHdf5(self.sample_file) as h5:
+			h5.add_dataset('/data', 'T', h5py.h5t.IEEE_F64LE, random_dataset)
+			h5.remove_dataset('/data', 'C')
+			h5.replace_attribute('/data', 'time_variables', [2.468E-04, 4.712E-07])
+			self.assertListEqual(h5.read_variables(), ['T'])
+
+		self.assertListEqual(hdf5_read_variables(self.sample_file), ['T'])
+		self.assertListEqual(list(hdf5_read_attribute(self.sample_file, '/data', 'dimensions')), [10, 10, 10, 1])
+		npt.assert_array_almost_equal(hdf5_read_dataset(self.sample_file, '/data', 'T'), random_dataset, 16)
+		npt.assert_array_equal(hdf5_read_attribute(self.sample_file, '/data', 'time_variables'),
+							   np.array([2.468E-04, 4.712E-07]))
+
+	def test_rfml_hdf5_nested_handles(self):
+		# reads and writes through other handles inside a block must not repack the open file
+		random_dataset = np.random.random_sample(self.dataset_dims)
+		hdf5_add_dataset(self.sample_file, '/data', 'D', h5py.h5t.IEEE_F64LE, random_dataset)
+		with RfmlHdf5(self.sample_file) as h5:
+			h5.remove_dataset('/data', 'C')
+			self.assertListEqual(hdf5_read_variables(self.sample_file), ['D'])
+			h5.add_dataset('/data', 'T', h5py.h5t.IEEE_F64LE, random_dataset)
+			hdf5_remove_dataset(self.sample_file, '/data', 'D')
+			self.assertListEqual(h5.read_variables(), ['T'])
+
+		self.assertListEqual(hdf5_read_variables(self.sample_file), ['T'])
+		self.assertNotIn(os.path.abspath(self.sample_file), rfml_hdf5._PENDING_REPACK)
+		npt.assert_array_equal(hdf5_read_dataset(self.sample_file, '/data', 'T'), random_dataset)
+
+	def test_rfml_hdf5_chunk_cache(self):
+		for mode in ['r', 'r+']:
+			with RfmlHdf5(self.sample_file, mode) as h5:
+				self.assertEqual(h5._fid.id.get_access_plist().get_cache(), (0, 1048583, 67108864, 0.75))
+
 	# === HDF5 NGA WRAPPER TESTS === #
 	def test_hdf5_NGA_config_write(self):
 		# write temporary config file
@@ -102,9 +271,54 @@ class TestHdf5Functions(unittest.TestCase):
 		npt.assert_array_almost_equal(hdf5_read_dataset('temp_config.h5', '/data', 'y'), y, 15)
 		npt.assert_array_almost_equal(hdf5_read_dataset('temp_config.h5', '/data', 'z'), z, 15)
 		npt.assert_array_equal(hdf5_read_dataset('temp_config.h5', '/data', 'mask'), mask)
+		npt.assert_array_almost_equal(hdf5_read_dataset('temp_config.h5', '/data', 'xm'), (x[1:] + x[:-1])/2.0, 15)
+		npt.assert_array_almost_equal(hdf5_read_dataset('temp_config.h5', '/data', 'ym'), (y[1:] + y[:-1])/2.0, 15)
+		npt.assert_array_almost_equal(hdf5_read_dataset('temp_config.h5', '/data', 'zm'), (z[1:] + z[:-1])/2.0, 15)
 
 		os.system('rm temp_config.h5')
 
+	def test_hdf5_NGA_config_write_packed_mask(self):
+		x = np.linspace(-1.0, 1.0, 6)
+		y = np.linspace(-2.0, 2.0, 11)
+		z = np.linspace(-4.0, 4.0, 21)
+		mask = (np.random.random_sample((5, 10)) > 0.5).astype(np.int32)
+		hdf5_NGA_config_write('temp_config.h5', 'isotropic_turbulence', x, y, z, 0, [1, 1, 1], mask, pack_mask=True)
+
+		self.assertEqual(hdf5_read_dataset('temp_config.h5', '/data', 'mask').size, 7)
+		npt.assert_array_equal(hdf5_read_attribute('temp_config.h5', '/data', 'mask_packed'), [5, 10])
+		npt.assert_array_equal(hdf5_read_mask('temp_config.h5'), mask)
+
+		# masks with other values are written unpacked
+		mask[0, 0] = 2
+		hdf5_NGA_config_write('temp_config.h5', 'isotropic_turbulence', x, y, z, 0, [1, 1, 1], mask, pack_mask=True)
+		npt.assert_array_equal(hdf5_read_dataset('temp_config.h5', '/data', 'mask'), mask)
+		npt.assert_array_equal(hdf5_read_mask('temp_config.h5'), mask)
+
+		os.system('rm temp_config.h5')
+
+	def test_midpoints(self):
+		try:
+			import numba
+		except ImportError:
+			self.skipTest('numba not installed')
+		x = np.linspace(-1.0, 1.0, 101)
+		expected = (x[1:] + x[:-1])/2.0
+		min_size = rfml_hdf5._NUMBA_MIN_SIZE
+		rfml_hdf5._NUMBA_MIN_SIZE = 0
+		try:
+			# numba kernel
+			npt.assert_array_almost_equal(rfml_hdf5._midpoints(x), expected, 15)
+			self.assertIsNotNone(rfml_hdf5._midpoints_numba())
+			# numpy fallback, as without numba
+			kernel = rfml_hdf5._MIDPOINTS_NB
+			rfml_hdf5._MIDPOINTS_NB = False
+			try:
+				npt.assert_array_almost_equal(rfml_hdf5._midpoints(x), expected, 15)
+			finally:
+				rfml_hdf5._MIDPOINTS_NB = kernel
+		finally:
+			rfml_hdf5._NUMBA_MIN_SIZE = min_size
+
 	def test_hdf5_NGA_data_write(self):
 		test_data_file = 'test_NGA_data.h5'
 		data = {'U': np.random.random_sample(self.dataset_dims),
@@ -132,6 +346,22 @@ class TestHdf5Functions(unittest.TestCase):
 
 		fid.close()
 
+	def test_hdf5_NGA_data_write_compression(self):
+		test_data_file = 'test_NGA_data.h5'
+		data = {'U': np.random.random_sample(self.dataset_dims)}
+		hdf5_NGA_data_write(test_data_file, data, 1.0E-04, 2E-07, compression='lzf')
+		fid = h5py.File(test_data_file, 'r')
+		self.assertEqual(fid['data']['U'].compression, 'lzf')
+		self.assertTrue(fid['data']['U'].shuffle)
+		fid.close()
+		npt.assert_array_equal(hdf5_read_dataset(test_data_file, '/data', 'U'), data.get('U'))
+
+		hdf5_NGA_data_write(test_data_file, data, 1.0E-04, 2E-07, compression=None)
+		fid = h5py.File(test_data_file, 'r')
+		self.assertIsNone(fid['data']['U'].chunks)
+		fid.close()
+		os.system('rm ' + test_data_file)
+
 
 if __name__ == '__main__':
 	unittest.main()